@@ -7,20 +7,25 @@
 """
 
 import can
-import struct
 import time
 import sys
 import math
 import argparse
+import numpy as np
+
+from can_common import (INT16X3_STRUCT, MODE_POS, DISABLE, reg_f32_payload, clamp_i16,
+                        build_msg, new_timespec, seconds_to_ns, wait_next_tick)
 
 
 class MotorAngleStreamController:
     """高擎电机角度流控制器"""
 
-    def __init__(self, channel: str = 'can0', bitrate: int = 1000000, motor_id: int = 1):
+    def __init__(self, channel: str = 'can0', bitrate: int = 1000000, motor_id: int = 1,
+                 debug: bool = False):
         self.motor_id = motor_id
         self.channel = channel
         self.bitrate = bitrate
+        self.debug = debug
         self.bus = None
 
         # SDK 系数定义
@@ -28,6 +33,31 @@ class MotorAngleStreamController:
         self.FACTOR_VEL = 4000.0   # 1r/s = 4000
         self.FACTOR_TQE = 200.0   # 通用电机系数
 
+        # 折叠后的缩放系数: 每个量只需一次乘法
+        self._pos_scale = self.FACTOR_POS / 360.0  # 度 -> 位置计数
+        self._vel_scale = self.FACTOR_VEL
+        self._tqe_scale = self.FACTOR_TQE
+
+        # 控制周期
+        self.CONTROL_PERIOD = 0.01  # 100Hz
+        # 控制循环中状态显示的降频倍数 (100Hz / 10 = 10Hz 刷新)
+        self._print_every = 10
+
+        # 预构建常量帧 (使能/PID/禁用)，避免每次调用重复分配
+        arb_id = 0x0000 | self.motor_id
+        self._enable_msg = build_msg(arb_id, MODE_POS)
+        self._kp_msg = build_msg(arb_id, reg_f32_payload(0x23, 1.0))
+        self._kd_msg = build_msg(arb_id, reg_f32_payload(0x24, 0.1))
+        self._disable_msg = build_msg(arb_id, DISABLE)
+
+        # 0x90 流指令帧: 复用同一个 Message，载荷原地改写
+        # 结构: [PosL, PosH, VelL, VelH, TqeL, TqeH, 0x50, 0x50]
+        self._stream_msg = build_msg(0x0090, bytearray(b'\x00' * 6 + b'\x50\x50'))
+        self._stream_buf = self._stream_msg.data
+        self._pack_stream = INT16X3_STRUCT.pack_into
+        self._stream_fields = None  # 最近一次打包的 (pos, vel, tqe)
+        self._burst_task = None     # set_angle 的定量连发任务
+
     def connect(self) -> bool:
         """连接CAN总线"""
         print(f"初始化 CAN: {self.channel}")
@@ -44,12 +74,22 @@ class MotorAngleStreamController:
 
     def send_frame(self, arbitration_id, data):
         """发送CAN帧"""
-        msg = can.Message(arbitration_id=arbitration_id, data=data,
-                         is_extended_id=True, is_fd=False)
+        self.send_msg(build_msg(arbitration_id, data))
+
+    def send_msg(self, msg: can.Message):
+        """
+        发送预构建的CAN帧
+        先非阻塞发送；内核发送队列已满 (ENOBUFS) 时让出约两帧时间，
+        再带 10ms 超时重试一次，仍失败则丢弃该帧
+        """
         try:
-            self.bus.send(msg)
+            self.bus.send(msg, timeout=0)
         except can.CanError:
-            pass
+            time.sleep(0.0005)
+            try:
+                self.bus.send(msg, timeout=0.01)
+            except can.CanError:
+                pass
 
     def enable_motor(self):
         """
@@ -58,16 +98,15 @@ class MotorAngleStreamController:
         print(f"-> [ID {self.motor_id}] 发送使能指令 (Register Mode)...")
         # 1. 写入模式: 0x0A (Position Mode)
         # ID: 0x0001 (Cmd 0x01 Write Int8)
-        arb_id = 0x0000 | self.motor_id
-        self.send_frame(arb_id, [0x01, 0x00, 0x0A, 0x50, 0x50, 0x50, 0x50, 0x50])
+        self.send_msg(self._enable_msg)
         time.sleep(0.05)
 
         # 2. 预设 PID (给一点刚度)
         # Reg 0x23 (Kp) = 1.0
-        self.send_frame(arb_id, [0x0D, 0x23] + list(struct.pack('<f', 1.0)) + [0x50, 0x50])
+        self.send_msg(self._kp_msg)
         time.sleep(0.02)
         # Reg 0x24 (Kd) = 0.1
-        self.send_frame(arb_id, [0x0D, 0x24] + list(struct.pack('<f', 0.1)) + [0x50, 0x50])
+        self.send_msg(self._kd_msg)
 
         print("✅ 电机已激活，准备发送流控制指令")
 
@@ -77,40 +116,78 @@ class MotorAngleStreamController:
         ID: 0x0090 (由 SDK 0x90 推断)
         Payload: [Pos(int16), Vel(int16), Tqe(int16), Padding...]
         """
-        # 1. 计算数值
-        pos_int = int((angle_deg / 360.0) * self.FACTOR_POS)
-        vel_int = int(max_vel_rps * self.FACTOR_VEL)
-        tqe_int = int(max_tqe_nm * self.FACTOR_TQE)
+        # 1~2. 计算数值并打包
+        self._pack_0x90(angle_deg, max_vel_rps, max_tqe_nm)
+
+        # 3. 发送至 ID 0x0090 (不需回复) 或 0x8090 (需回复)
+        # 这里尝试 0x0090
+        self.send_msg(self._stream_msg)
+
+        if self.debug:
+            print(f"   >>> 0x90流指令: Ang={angle_deg}° Vel={max_vel_rps} Tqe={max_tqe_nm} (Raw: {list(self._stream_buf[:6])})")
 
+    def _pack_0x90(self, angle_deg, max_vel_rps, max_tqe_nm) -> bool:
+        """计算 0x90 数值并原地打包到缓存载荷，返回载荷是否发生变化"""
         # 限幅 Int16
-        pos_int = max(min(pos_int, 32767), -32768)
-        vel_int = max(min(vel_int, 32767), -32768)
-        tqe_int = max(min(tqe_int, 32767), -32768)
+        pos_int = clamp_i16(int(angle_deg * self._pos_scale))
+        vel_int = clamp_i16(int(max_vel_rps * self._vel_scale))
+        tqe_int = clamp_i16(int(max_tqe_nm * self._tqe_scale))
+
+        return self._pack_0x90_raw(pos_int, vel_int, tqe_int)
+
+    def _pack_0x90_raw(self, pos_int, vel_int, tqe_int) -> bool:
+        """将已缩放限幅的 Int16 数值原地打包到缓存载荷，返回载荷是否发生变化"""
+        fields = (pos_int, vel_int, tqe_int)
+        if fields == self._stream_fields:
+            return False
+        self._stream_fields = fields
 
-        # 2. 打包数据
+        # 原地打包 (末尾 0x50 0x50 填充已预置)
         # 结构: [PosL, PosH, VelL, VelH, TqeL, TqeH]
-        data = struct.pack('<hhh', pos_int, vel_int, tqe_int)
+        self._pack_stream(self._stream_buf, 0, pos_int, vel_int, tqe_int)
+        return True
 
-        # 补齐 8 字节
-        payload = list(data) + [0x50, 0x50]
+    def start_stream_task(self, angle_deg, max_vel_rps, max_tqe_nm):
+        """
+        以 CONTROL_PERIOD 周期启动 0x90 流指令的周期发送
+        SocketCAN 下由内核 BCM 负责按周期发帧，Python 只需在载荷变化时调用
+        update_stream_task 更新模板；用完需调用 task.stop()
+        """
+        self._pack_0x90(angle_deg, max_vel_rps, max_tqe_nm)
+        return self.bus.send_periodic(self._stream_msg, self.CONTROL_PERIOD, store_task=False)
 
-        # 3. 发送至 ID 0x0090 (不需回复) 或 0x8090 (需回复)
-        # 这里尝试 0x0090
-        self.send_frame(0x0090, payload)
+    def update_stream_task(self, task, angle_deg, max_vel_rps, max_tqe_nm):
+        """更新周期发送的 0x90 载荷，数值未变化时不触发任何系统调用"""
+        if self._pack_0x90(angle_deg, max_vel_rps, max_tqe_nm):
+            task.modify_data(self._stream_msg)
 
-        print(f"   >>> 0x90流指令: Ang={angle_deg}° Vel={max_vel_rps} Tqe={max_tqe_nm} (Raw: {payload[:6]})")
+    def _stop_burst(self):
+        """停止尚未发完的 set_angle 连发任务"""
+        if self._burst_task is not None:
+            self._burst_task.stop()
+            self._burst_task = None
 
     def disable_motor(self):
         """禁用电机"""
-        arb_id = 0x0000 | self.motor_id
-        self.send_frame(arb_id, [0x01, 0x00, 0x00, 0x50, 0x50, 0x50, 0x50, 0x50])
+        self._stop_burst()
+        self.send_msg(self._disable_msg)
         print("🛑 电机已禁用")
 
     def set_angle(self, angle_deg, max_vel_rps=2.0, max_tqe_nm=3.0, send_count=5):
-        """设置角度位置"""
-        for i in range(send_count):
-            self.send_0x90_command(angle_deg, max_vel_rps, max_tqe_nm)
-            time.sleep(0.01)
+        """
+        设置角度位置
+        以 CONTROL_PERIOD 间隔连发 send_count 帧，由定量周期发送任务完成，
+        调用立即返回；新指令会替换尚未发完的旧指令
+        """
+        self._stop_burst()
+        if send_count <= 0:
+            return  # duration=0 会被当作无限期发送
+        self._pack_0x90(angle_deg, max_vel_rps, max_tqe_nm)
+        period = self.CONTROL_PERIOD
+        # 多给百万分之一个周期: BCM 计数 int(duration / period) 不受浮点误差影响，线程回退也在第 send_count 帧时刻停止
+        self._burst_task = self.bus.send_periodic(self._stream_msg, period,
+                                                  duration=(send_count + 1e-6) * period,
+                                                  store_task=False)
 
     def run_interactive_control(self):
         """运行交互式角度控制"""
@@ -152,26 +229,44 @@ class MotorAngleStreamController:
         print(f"幅值: {amplitude_deg}°, 频率: {frequency} Hz, 时长: {duration}s")
         print("="*50)
 
+        task = None
         try:
             # 1. 先使能电机
             self.enable_motor()
 
-            start_time = time.time()
-            while time.time() - start_time < duration:
-                # 计算目标角度
-                elapsed = time.time() - start_time
-                target_deg = amplitude_deg * math.sin(2 * math.pi * frequency * elapsed)
-
-                # 发送角度指令
-                self.set_angle(target_deg)
+            # 轨迹已知，一次性向量化生成每个周期的目标角度及其 Int16 位置值
+            # (astype 与 int() 同为向零截断)；tolist() 后按下标取值，比逐个拆箱 numpy 标量更快
+            period = self.CONTROL_PERIOD
+            t = np.arange(0.0, duration, period)
+            angles = amplitude_deg * np.sin(2 * np.pi * frequency * t)
+            trajectory = angles.tolist()
+            pos_ints = np.clip(angles * self._pos_scale, -32768, 32767).astype(np.int16).tolist()
+            vel_int = clamp_i16(int(2.0 * self._vel_scale))
+            tqe_int = clamp_i16(int(3.0 * self._tqe_scale))
+
+            # 2. 由周期发送任务按固定节拍发帧，循环内只更新载荷 (正弦起点为 0°)
+            task = self.start_stream_task(0.0, 2.0, 3.0)
+
+            period_ns = seconds_to_ns(period)
+            ts = new_timespec()
+            next_tick = time.monotonic_ns()
+            for tick, target_deg in enumerate(trajectory):
+                # 更新角度指令
+                if self._pack_0x90_raw(pos_ints[tick], vel_int, tqe_int):
+                    task.modify_data(self._stream_msg)
+
+                # 显示当前状态 (降频刷新，避免 stdout I/O 占用控制周期)
+                if tick % self._print_every == 0:
+                    sys.stdout.write("\r目标: %7.1f°" % target_deg)
+                    sys.stdout.flush()
 
-                # 显示当前状态
-                print(f"\r目标: {target_deg:7.1f}°", end="")
-                sys.stdout.flush()
+                next_tick = wait_next_tick(next_tick, period_ns, ts)
 
         except KeyboardInterrupt:
             print("\n中断")
         finally:
+            if task is not None:
+                task.stop()
             self.disable_motor()
 
     def run_step_control(self, angles: list, step_duration: float):
@@ -182,26 +277,35 @@ class MotorAngleStreamController:
         print(f"每步时长: {step_duration}s")
         print("="*50)
 
+        task = None
         try:
             # 1. 先使能电机
             self.enable_motor()
 
+            ts = new_timespec()
             for i, angle_deg in enumerate(angles):
                 print(f"\n--- 步骤 {i+1}/{len(angles)}: {angle_deg}° ---")
 
-                # 发送角度指令
-                self.set_angle(angle_deg)
+                # 更新角度指令，整个步长内由周期发送任务持续发帧
+                if task is None:
+                    task = self.start_stream_task(angle_deg, 2.0, 3.0)
+                else:
+                    self.update_stream_task(task, angle_deg, 2.0, 3.0)
 
                 # 等待步长时间
-                step_start = time.time()
-                while time.time() - step_start < step_duration:
-                    print(f"\r剩余时间: {step_duration - (time.time() - step_start):.1f}s", end="")
+                step_start = time.monotonic_ns()
+                step_end = step_start + seconds_to_ns(step_duration)
+                next_tick = step_start
+                while next_tick < step_end:
+                    print(f"\r剩余时间: {(step_end - time.monotonic_ns()) * 1e-9:.1f}s", end="")
                     sys.stdout.flush()
-                    time.sleep(0.1)
+                    next_tick = wait_next_tick(next_tick, 100_000_000, ts)  # 0.1s 刷新
 
         except KeyboardInterrupt:
             print("\n中断")
         finally:
+            if task is not None:
+                task.stop()
             self.disable_motor()
 
     def run_mit_control(self, target_deg: float, stiffness: float, damping: float, duration: float):
@@ -214,40 +318,53 @@ class MotorAngleStreamController:
         print(f"控制时长: {duration}s")
         print("="*50)
 
+        task = None
         try:
             # 1. 先使能电机
             self.enable_motor()
 
-            start_time = time.time()
+            # 2. 交给内核周期发送，循环内只在力矩变化时更新载荷
+            task = self.start_stream_task(target_deg, 2.0, 0.0)
+
+            period = self.CONTROL_PERIOD
+            # 循环按固定周期调度，dt 即 period，微分项系数可提前算好
+            inv_dt = 1.0 / (period + 0.001)
+            target_rad = math.radians(target_deg)
+            period_ns = seconds_to_ns(period)
+            ts = new_timespec()
+            start_time = time.monotonic_ns()
+            end_time = start_time + seconds_to_ns(duration)
+            next_tick = start_time
             last_error = 0.0
-            last_time = start_time
+            tick = 0
 
-            while time.time() - start_time < duration:
+            while next_tick < end_time:
                 # 获取当前状态 (需要实现状态读取)
                 # 这里简化处理，实际应该读取电机反馈
-                current_time = time.time()
-                dt = current_time - last_time
 
                 # 简化的误差计算 (实际应该读取电机当前位置)
                 # 这里假设角度直接对应位置
-                error = math.radians(target_deg) - math.radians(target_deg)  # 临时简化
+                error = target_rad - target_rad  # 临时简化
 
                 # MIT控制律
-                desired_torque = stiffness * error + damping * (error - last_error) / (dt + 0.001)
+                desired_torque = stiffness * error + damping * (error - last_error) * inv_dt
 
-                # 发送控制指令 (转换为角度+速度+力矩)
-                self.send_0x90_command(target_deg, 2.0, abs(desired_torque))
+                # 更新控制指令 (转换为角度+速度+力矩)
+                self.update_stream_task(task, target_deg, 2.0, abs(desired_torque))
 
-                print(f"\r目标: {target_deg:6.1f}° 力矩: {desired_torque:6.3f}Nm", end="")
-                sys.stdout.flush()
+                if tick % self._print_every == 0:
+                    sys.stdout.write("\r目标: %6.1f° 力矩: %6.3fNm" % (target_deg, desired_torque))
+                    sys.stdout.flush()
+                tick += 1
 
                 last_error = error
-                last_time = current_time
-                time.sleep(0.01)  # 100Hz控制频率
+                next_tick = wait_next_tick(next_tick, period_ns, ts)  # 100Hz控制频率
 
         except KeyboardInterrupt:
             print("\n中断")
         finally:
+            if task is not None:
+                task.stop()
             self.disable_motor()
 
     def test_positions(self, positions: list):
@@ -280,6 +397,7 @@ class MotorAngleStreamController:
     def cleanup(self):
         """清理资源"""
         if self.bus:
+            self._stop_burst()
             self.bus.shutdown()
             self.bus = None
 
@@ -289,6 +407,7 @@ def main():
     parser.add_argument('--channel', type=str, default='can0', help='CAN通道')
     parser.add_argument('--bitrate', type=int, default=1000000, help='CAN波特率')
     parser.add_argument('--motor_id', type=int, default=1, help='电机ID')
+    parser.add_argument('--debug', action='store_true', help='打印每一帧0x90流指令')
 
     parser.add_argument('--mode', type=str, default='interactive',
                        choices=['interactive', 'sine', 'step', 'mit', 'test'],
@@ -308,7 +427,7 @@ def main():
     args = parser.parse_args()
 
     # 创建控制器
-    controller = MotorAngleStreamController(args.channel, args.bitrate, args.motor_id)
+    controller = MotorAngleStreamController(args.channel, args.bitrate, args.motor_id, args.debug)
 
     try:
         # 连接CAN总线
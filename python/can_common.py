@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+高擎电机 CAN 公共定义
+各控制脚本与扫描工具共用的帧格式、固定载荷、辅助函数与周期调度
+(脚本所在目录在 sys.path 首位，从任意工作目录运行 python3 python/xxx.py 均可导入)
+"""
+
+import can
+import ctypes
+import ctypes.util
+import struct
+import sys
+import time
+from typing import Optional
+
+
+# Linux SocketCAN struct can_frame: can_id(u32) + len(u8) + 3字节填充 + data[8]
+CAN_FRAME = struct.Struct('=IB3x8s')
+CAN_FRAME_HEADER = struct.Struct('=IB3x')
+CAN_MTU = 16
+CANFD_MTU = 72  # 原始接收缓冲按 CAN FD 帧长分配，兼容两种帧
+CAN_EFF_FLAG = 0x80000000  # 扩展帧标志位
+CAN_RTR_FLAG = 0x40000000
+CAN_ERR_FLAG = 0x20000000
+CAN_EFF_MASK = 0x1FFFFFFF
+
+# 寄存器写 float: Cmd, Reg, Value
+REG_F32_STRUCT = struct.Struct('<BBf')
+
+# 3 × Int16 控制载荷: 0x90 Pos, Vel, Tqe / 0xAD Pos, Vel, Acc
+INT16X3_STRUCT = struct.Struct('<hhh')
+
+# 固定载荷 (Cmd 0x01 写 Int8, 寄存器 0x00 = 模式)
+MODE_POS = bytes((0x01, 0x00, 0x0A, 0x50, 0x50, 0x50, 0x50, 0x50))  # 进入 0x0A 位置/控制模式
+DISABLE = bytes((0x01, 0x00, 0x00, 0x50, 0x50, 0x50, 0x50, 0x50))   # 停止模式
+
+
+def reg_f32_payload(reg: int, value: float) -> bytes:
+    """寄存器写 float 载荷: [0x0D, Reg, f32(LE), 0x50, 0x50]"""
+    buf = bytearray(b'\x50' * 8)
+    REG_F32_STRUCT.pack_into(buf, 0, 0x0D, reg, value)
+    return bytes(buf)
+
+
+def clamp_i16(v: int) -> int:
+    """Int16 饱和限幅 (单个条件表达式，不经过 min/max 内建调用)"""
+    return -32768 if v < -32768 else (32767 if v > 32767 else v)
+
+
+def build_msg(arbitration_id, data) -> can.Message:
+    """构建扩展帧 (非FD)"""
+    return can.Message(arbitration_id=arbitration_id, data=data,
+                       is_extended_id=True, is_fd=False)
+
+
+class Timespec(ctypes.Structure):
+    """struct timespec"""
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+_CLOCK_MONOTONIC = 1  # Linux: 与 time.monotonic_ns 为同一时钟
+_TIMER_ABSTIME = 1
+
+
+def _load_clock_nanosleep():
+    """取 libc 的 clock_nanosleep (标准库未提供)，非 Linux 或不可用时返回 None"""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6')
+        fn = libc.clock_nanosleep
+    except (OSError, AttributeError):
+        return None
+    fn.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.POINTER(Timespec), ctypes.c_void_p)
+    fn.restype = ctypes.c_int
+    return fn
+
+
+_clock_nanosleep = _load_clock_nanosleep()
+
+
+def new_timespec() -> Optional[Timespec]:
+    """供 wait_next_tick 复用的 timespec (每个线程一份)；clock_nanosleep 不可用时返回 None"""
+    return Timespec() if _clock_nanosleep is not None else None
+
+
+def seconds_to_ns(seconds: float) -> int:
+    """秒 -> 整数纳秒，四舍五入避免 1/rate 这类周期被截短 1ns"""
+    return round(seconds * 1e9)
+
+
+def wait_next_tick(tick_ns: int, period_ns: int, ts: Optional[Timespec] = None) -> int:
+    """
+    按绝对时刻等待下一个控制周期: tick_ns 为本周期起点 (monotonic 纳秒)，
+    睡到 tick_ns + period_ns 后返回该时刻，作为下一周期的起点
+    睡眠时长随本周期耗时自动伸缩，整数纳秒累加不会随运行时长损失精度；
+    传入 ts (见 new_timespec) 时以 clock_nanosleep(TIMER_ABSTIME) 直接睡到截止时刻，否则退回 time.sleep
+    """
+    tick_ns += period_ns
+    delay_ns = tick_ns - time.monotonic_ns()
+    if delay_ns > 0:
+        if ts is not None:
+            ts.tv_sec, ts.tv_nsec = divmod(tick_ns, 1_000_000_000)
+            _clock_nanosleep(_CLOCK_MONOTONIC, _TIMER_ABSTIME, ts, None)
+        else:
+            time.sleep(delay_ns * 1e-9)
+    elif delay_ns < -period_ns:
+        # 落后超过一个周期 (如被抢占)，重新对齐，避免连发补帧
+        tick_ns = time.monotonic_ns()
+    return tick_ns
@@ -8,11 +8,18 @@
 
 import can
 import time
-import struct
 import argparse
+import select
 import sys
 from typing import List, Dict, Optional, Tuple
 
+from can_common import (CAN_FRAME_HEADER, CAN_MTU, CANFD_MTU, CAN_RTR_FLAG, CAN_ERR_FLAG,
+                        CAN_EFF_MASK, build_msg)
+
+
+# Ping 载荷: CMD 0x11 (读 int8 ×1) + 地址 0x00 (电机模式) + 填充 0x50
+_PING = bytes((0x11, 0x00, 0x50, 0x50, 0x50, 0x50, 0x50, 0x50))
+
 
 class LivelyMotorScanner:
     """高擎电机CAN扫描器"""
@@ -22,6 +29,12 @@ class LivelyMotorScanner:
         self.bitrate = bitrate
         self.bus = None
 
+        # Ping 帧内容固定，按电机ID (1-127) 预先构建并缓存
+        self._ping_cache = {motor_id: self._new_ping_frame(motor_id) for motor_id in range(1, 128)}
+
+        # 原始 SocketCAN 接收缓冲
+        self._rx_buf = bytearray(CANFD_MTU)
+
     def connect(self) -> bool:
         """连接CAN总线"""
         print(f"正在初始化 {self.channel} @ {self.bitrate}bps ...")
@@ -43,54 +56,66 @@ class LivelyMotorScanner:
             self.bus.shutdown()
             self.bus = None
 
+    def _new_ping_frame(self, motor_id: int) -> can.Message:
+        """新建Ping指令帧"""
+        # CAN ID: 高8位设置Bit15=1表示需要回复，低8位为电机ID
+        arbitration_id = 0x8000 | (motor_id & 0xFF)
+
+        # 必须开启扩展帧以支持16位ID，强制普通CAN
+        return build_msg(arbitration_id, _PING)
+
     def build_ping_frame(self, motor_id: int) -> can.Message:
         """
-        构建Ping指令帧
+        构建Ping指令帧 (1-127 直接返回缓存帧)
         协议: ID 高8位(Bit15=1表示需回复) | 低8位(电机ID)
         CMD: 0x11 = 读(0x1_) + int8(0x_0) + 1个数据(0x_1)
         地址: 0x00 = 读取电机模式
         """
-        # CAN ID: 高8位设置Bit15=1表示需要回复，低8位为电机ID
-        arbitration_id = 0x8000 | (motor_id & 0xFF)
-
-        # 数据: CMD 0x11 + 地址 0x00 + 填充 0x50
-        data = [0x11, 0x00, 0x50, 0x50, 0x50, 0x50, 0x50, 0x50]
-
-        return can.Message(
-            arbitration_id=arbitration_id,
-            data=data,
-            is_extended_id=True,  # 必须开启扩展帧以支持16位ID
-            is_fd=False           # 强制普通CAN
-        )
+        msg = self._ping_cache.get(motor_id)
+        if msg is None:
+            msg = self._new_ping_frame(motor_id)
+        return msg
 
     def parse_response(self, rx_msg: can.Message, target_id: int) -> Optional[int]:
         """解析响应消息，返回检测到的电机ID"""
-        can_id = rx_msg.arbitration_id
-        raw_id = can_id & 0xFFFF
+        return self._detect_id(rx_msg.arbitration_id, target_id)
 
-        # 尝试解析源ID
-        source_id = (raw_id >> 8) & 0x7F
-        direct_id = can_id & 0xFF
+    @staticmethod
+    def _detect_id(can_id: int, target_id: int) -> Optional[int]:
+        """由CAN ID解析电机ID"""
+        # 源ID: 高字节低7位 ((can_id & 0xFFFF) >> 8 & 0x7F 的等价折叠)，非0即有效
+        source_id = (can_id >> 8) & 0x7F
+        if source_id:
+            return source_id
 
-        detected_id = None
-        if 0 < source_id < 128:
-            detected_id = source_id
-        elif direct_id == target_id:
-            detected_id = direct_id
+        # 否则退回到低8位直连ID
+        direct_id = can_id & 0xFF
+        return direct_id if direct_id == target_id else None
 
-        return detected_id
+    @staticmethod
+    def _detect_reply_id(can_id: int, data) -> Optional[int]:
+        """
+        批量模式下由响应帧解析电机ID (没有单一目标ID)
+        低8位直连ID只认电机响应: Bit15 需回复位或读/写指令 (CMD < 0x20，如 Ping 的 0x11、
+        使能的 0x01) 说明是其他主机发出的请求帧，不计为电机
+        """
+        source_id = (can_id >> 8) & 0x7F
+        if source_id:
+            return source_id
+        if can_id & 0x8000 or not data or data[0] < 0x20:
+            return None
+        return can_id & 0xFF
 
     def scan_single_motor(self, motor_id: int, timeout: float = 0.05) -> bool:
         """扫描单个电机ID"""
         try:
             # 发送ping帧
             ping_msg = self.build_ping_frame(motor_id)
-            self.bus.send(ping_msg)
-            time.sleep(0.01)  # 防止发送太快
+            self.send_ping(ping_msg)
 
-            # 监听响应
-            time_end = time.time() + timeout
-            while time.time() < time_end:
+            # 监听响应 (响应通常 <1ms 到达，直接进入接收窗口)
+            time_end = time.monotonic() + timeout
+            while time.monotonic() < time_end:
                 rx_msg = self.bus.recv(timeout=0.01)
                 if rx_msg and not rx_msg.is_error_frame:
                     detected_id = self.parse_response(rx_msg, motor_id)
@@ -104,74 +129,152 @@ class LivelyMotorScanner:
             print(">>> 严重警告: 物理层不通，请检查接线和120Ω电阻！")
             return False
 
-    def scan_range(self, start_id: int = 1, end_id: int = 14, timeout: float = 0.05) -> List[int]:
-        """扫描ID范围内的所有电机"""
+    def send_ping(self, ping_msg: can.Message):
+        """发送Ping帧，发送队列满时稍等一帧时间重试一次"""
+        try:
+            self.bus.send(ping_msg)
+        except can.CanError:
+            time.sleep(0.001)
+            self.bus.send(ping_msg)
+
+    def scan_batch(self, motor_ids: List[int], timeout: float = 0.05,
+                   expected: Optional[int] = None,
+                   silence_timeout: Optional[float] = None) -> Dict[int, Dict]:
+        """
+        批量Ping一组电机
+        先连续发出全部Ping帧，再在同一个超时窗口内收集响应，
+        总耗时约为一个 timeout 而不是 N 个；返回 {电机ID: 信息}
+
+        以下情况提前结束等待:
+        - 全部目标 (或 expected 个) 电机均已响应
+        - 设置了 silence_timeout 且距上一个新响应已超过该时长
+        """
+        target_ids = set(motor_ids)
+        wanted = len(target_ids) if expected is None else min(expected, len(target_ids))
+        results = {}
+
+        # 1. 批量发送
+        for motor_id in motor_ids:
+            self.send_ping(self.build_ping_frame(motor_id))
+
+        # 2. 统一收集响应，按源ID区分电机
+        # SocketCAN 下直接读底层 socket，只解析需要的字段，不为每帧构造 can.Message
+        sock = getattr(self.bus, 'socket', None)
+        if sock is not None:
+            self._collect_raw(sock, target_ids, timeout, results, wanted, silence_timeout)
+        else:
+            self._collect_bus(target_ids, timeout, results, wanted, silence_timeout)
+        return results
+
+    def _collect_bus(self, target_ids: set, timeout: float, results: Dict[int, Dict],
+                     wanted: int, silence_timeout: Optional[float]):
+        """在 timeout 窗口内经 python-can 收集响应，写入 results"""
+        hard_end = time.monotonic() + timeout
+        time_end = hard_end
+        while time.monotonic() < time_end:
+            rx_msg = self.bus.recv(timeout=0.005)
+            if rx_msg and not rx_msg.is_error_frame:
+                detected_id = self._detect_reply_id(rx_msg.arbitration_id, rx_msg.data)
+                if detected_id in target_ids and detected_id not in results:
+                    results[detected_id] = self._build_motor_info(
+                        detected_id, rx_msg.arbitration_id, rx_msg.data)
+                    if len(results) >= wanted:
+                        break
+                    if silence_timeout is not None:
+                        time_end = min(hard_end, time.monotonic() + silence_timeout)
+
+    def _collect_raw(self, sock, target_ids: set, timeout: float, results: Dict[int, Dict],
+                     wanted: int, silence_timeout: Optional[float]):
+        """在 timeout 窗口内从原始 SocketCAN socket 收集响应，写入 results"""
+        buf = self._rx_buf
+        unpack_header = CAN_FRAME_HEADER.unpack_from
+        hard_end = time.monotonic() + timeout
+        time_end = hard_end
+        while True:
+            remaining = time_end - time.monotonic()
+            if remaining <= 0 or not select.select([sock], [], [], remaining)[0]:
+                break
+            if sock.recv_into(buf) < CAN_MTU:
+                continue
+
+            can_id, length = unpack_header(buf)
+            if can_id & (CAN_ERR_FLAG | CAN_RTR_FLAG):
+                continue
+            can_id &= CAN_EFF_MASK
+
+            data = buf[8:8 + length]
+            detected_id = self._detect_reply_id(can_id, data)
+            if detected_id in target_ids and detected_id not in results:
+                results[detected_id] = self._build_motor_info(detected_id, can_id, data)
+                if len(results) >= wanted:
+                    break
+                if silence_timeout is not None:
+                    time_end = min(hard_end, time.monotonic() + silence_timeout)
+
+    def scan_range(self, start_id: int = 1, end_id: int = 14, timeout: float = 0.05,
+                   expected: Optional[int] = None,
+                   silence_timeout: Optional[float] = None) -> List[int]:
+        """扫描ID范围内的所有电机 (expected / silence_timeout 见 scan_batch)"""
         print(f"\n{'='*50}")
         print(f"开始扫描电机 ID (范围: {start_id}-{end_id})...")
-        print(f"超时时间: {timeout}秒/电机")
+        print(f"超时时间: {timeout}秒 (批量等待窗口)")
         print("按 Ctrl+C 可随时停止")
         print(f"{'='*50}")
 
         found_ids = []
 
         try:
-            for target_id in range(start_id, end_id + 1):
-                print(f"扫描 ID {target_id:2d}...", end=" ")
-                if self.scan_single_motor(target_id, timeout):
-                    found_ids.append(target_id)
-                else:
-                    print("无响应")
+            results = self.scan_batch(list(range(start_id, end_id + 1)), timeout,
+                                      expected, silence_timeout)
+            for motor_id, info in sorted(results.items()):
+                print(f"✅ [响应] 发现电机 ID: {motor_id} (CAN ID: {info['can_id']})")
+            found_ids = sorted(results)
 
+        except can.CanError as e:
+            print(f"❌ 发送失败: {e}")
+            print(">>> 严重警告: 物理层不通，请检查接线和120Ω电阻！")
         except KeyboardInterrupt:
             print("\n⚠️ 用户中断扫描")
 
         return found_ids
 
-    def get_motor_info(self, motor_id: int) -> Optional[Dict]:
-        """获取电机详细信息"""
-        print(f"\n获取电机 {motor_id} 详细信息...")
+    def _build_motor_info(self, motor_id: int, can_id: int, data) -> Dict:
+        """由电机响应帧 (CAN ID + 数据) 构建信息字典"""
+        info = {
+            'id': motor_id,
+            'can_id': f"0x{can_id:X}",
+            'data': list(data),
+            'length': len(data),
+            'timestamp': time.time()
+        }
 
-        # 发送读取电机模式命令
+        # 尝试解析电机模式
+        if len(data) >= 2:
+            mode = data[1]
+            info['mode'] = f"0x{mode:02X}"
+            mode_names = {
+                0x00: "停止模式",
+                0x0A: "位置模式",
+                0x0B: "速度模式",
+                0x0C: "力矩模式"
+            }
+            if mode in mode_names:
+                info['mode_name'] = mode_names[mode]
+
+        return info
+
+    def query_motors(self, motor_ids: List[int], timeout: float = 0.1) -> Dict[int, Dict]:
+        """查询多个电机信息 (与扫描共用 scan_batch 的批量收发)，返回 {电机ID: 信息}，无响应的电机不在结果中"""
         try:
-            arbitration_id = 0x8000 | (motor_id & 0xFF)
-            data = [0x11, 0x00, 0x50, 0x50, 0x50, 0x50, 0x50, 0x50]
-            msg = can.Message(arbitration_id=arbitration_id, data=data, is_extended_id=True, is_fd=False)
-            self.bus.send(msg)
-
-            # 监听响应
-            time_end = time.time() + 0.1
-            while time.time() < time_end:
-                rx_msg = self.bus.recv(timeout=0.02)
-                if rx_msg and not rx_msg.is_error_frame:
-                    detected_id = self.parse_response(rx_msg, motor_id)
-                    if detected_id == motor_id:
-                        info = {
-                            'id': motor_id,
-                            'can_id': f"0x{rx_msg.arbitration_id:X}",
-                            'data': list(rx_msg.data),
-                            'length': len(rx_msg.data),
-                            'timestamp': time.time()
-                        }
-
-                        # 尝试解析电机模式
-                        if len(rx_msg.data) >= 2:
-                            mode = rx_msg.data[1]
-                            info['mode'] = f"0x{mode:02X}"
-                            mode_names = {
-                                0x00: "停止模式",
-                                0x0A: "位置模式",
-                                0x0B: "速度模式",
-                                0x0C: "力矩模式"
-                            }
-                            if mode in mode_names:
-                                info['mode_name'] = mode_names[mode]
-
-                        return info
-
-        except Exception as e:
+            return self.scan_batch(motor_ids, timeout)
+        except can.CanError as e:
             print(f"获取电机信息失败: {e}")
+            return {}
 
-        return None
+    def get_motor_info(self, motor_id: int) -> Optional[Dict]:
+        """获取电机详细信息"""
+        print(f"\n获取电机 {motor_id} 详细信息...")
+        return self.query_motors([motor_id]).get(motor_id)
 
     def continuous_monitor(self, motor_ids: List[int], duration: float = 30.0):
         """持续监控指定电机"""
@@ -182,16 +285,17 @@ class LivelyMotorScanner:
         print("按 Ctrl+C 提前停止")
         print(f"{'='*50}")
 
-        start_time = time.time()
+        start_time = time.monotonic()
 
         try:
-            while time.time() - start_time < duration:
-                current_time = time.time() - start_time
+            while time.monotonic() - start_time < duration:
+                current_time = time.monotonic() - start_time
                 print(f"\n时间: {current_time:.1f}s")
                 print("-" * 40)
 
+                infos = self.query_motors(motor_ids, 0.05)
                 for motor_id in motor_ids:
-                    info = self.get_motor_info(motor_id)
+                    info = infos.get(motor_id)
                     if info:
                         mode_name = info.get('mode_name', '未知模式')
                         print(f"电机 {motor_id:2d}: CAN ID={info['can_id']:<8} 模式={mode_name}")
@@ -240,11 +344,8 @@ class LivelyMotorScanner:
             'details': {}
         }
 
-        # 获取每个电机的详细信息
-        for motor_id in found_ids:
-            info = self.get_motor_info(motor_id)
-            if info:
-                report['details'][motor_id] = info
+        # 一次批量收发 (scan_batch) 获取所有电机的详细信息
+        report['details'] = self.query_motors(found_ids)
 
         return report
 
@@ -255,7 +356,9 @@ def main():
     parser.add_argument('--bitrate', type=int, default=1000000, help='CAN波特率')
     parser.add_argument('--start', type=int, default=1, help='扫描起始ID')
     parser.add_argument('--end', type=int, default=14, help='扫描结束ID')
-    parser.add_argument('--timeout', type=float, default=0.05, help='每个电机的超时时间(秒)')
+    parser.add_argument('--timeout', type=float, default=0.05, help='扫描响应等待窗口(秒)')
+    parser.add_argument('--expected', type=int, help='已知在线电机数量，全部响应后立即结束扫描')
+    parser.add_argument('--silence', type=float, help='收到响应后静默超过该时长(秒)即结束扫描')
     parser.add_argument('--detailed', action='store_true', help='获取电机详细信息')
     parser.add_argument('--monitor', type=float, help='持续监控时长(秒)')
     parser.add_argument('--test', type=int, help='测试指定电机ID的通信可靠性')
@@ -277,7 +380,8 @@ def main():
             return
 
         # 扫描电机
-        found_ids = scanner.scan_range(args.start, args.end, args.timeout)
+        found_ids = scanner.scan_range(args.start, args.end, args.timeout,
+                                       args.expected, args.silence)
 
         print(f"\n{'='*50}")
         if found_ids:
@@ -288,8 +392,9 @@ def main():
             if args.detailed:
                 print(f"\n{'='*50}")
                 print("电机详细信息:")
+                infos = scanner.query_motors(sorted(found_ids))
                 for motor_id in sorted(found_ids):
-                    info = scanner.get_motor_info(motor_id)
+                    info = infos.get(motor_id)
                     if info:
                         mode_name = info.get('mode_name', '未知模式')
                         print(f"\n电机 {motor_id}:")
@@ -7,32 +7,81 @@
 """
 
 import can
-import struct
 import time
 import sys
+import os
+import socket
+import gc
+import ctypes
+import ctypes.util
 import threading
 import argparse
-import math
+import selectors
+import numpy as np
+from typing import Optional
+
+from can_common import (CAN_FRAME, CANFD_MTU, CAN_EFF_FLAG, INT16X3_STRUCT, MODE_POS, DISABLE,
+                        reg_f32_payload, clamp_i16, build_msg,
+                        new_timespec, seconds_to_ns, wait_next_tick)
+
+
+# 固定载荷 (模块加载时打包一次)
+_TORQUE_LIMIT = reg_f32_payload(0x22, 3.0)  # Reg 0x22 力矩限制 = 3.0 Nm
+_VEL_KP = reg_f32_payload(0x23, 2.0)        # Reg 0x23 Kp = 2.0
+_VEL_KD = reg_f32_payload(0x24, 0.2)        # Reg 0x24 Kd = 0.2
+
+# 0xAD 控制帧模板 (Pos/Vel/Acc 由 _encode_ctrl 填入)，原始 can_frame 的载荷从第 8 字节开始
+_CTRL_PAYLOAD = bytes(6) + b'\x50\x50'
+_CTRL_RAW_FRAME = CAN_FRAME.pack(0x00AD | CAN_EFF_FLAG, 8, _CTRL_PAYLOAD)
+
+# 初始化步骤: (提示, 载荷, 未收到回复时的固定延时; None 表示直接连发、不请求回复)
+_INIT_STEPS = (
+    (None, MODE_POS, 0.05),                               # 1. 写入模式: 0x0A (Position/Control Mode)
+    ("   >>> 预设力矩限制: 3.0 Nm", _TORQUE_LIMIT, 0.02),  # 2. 【必须】力矩限制 3.0 Nm，确保有力气
+    (None, _VEL_KP, None),                                # 3. 预设 PID (速度环): Kp=2.0
+    (None, _VEL_KD, None),                                #    Kd=0.2
+)
+
+
+def lock_process_memory() -> bool:
+    """mlockall(MCL_CURRENT | MCL_FUTURE): 锁定进程内存，避免控制周期中发生缺页"""
+    MCL_CURRENT, MCL_FUTURE = 1, 2
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if libc.mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        return True
+    except (OSError, AttributeError) as e:
+        print(f"⚠️ 无法锁定内存 (需要 root 或 CAP_IPC_LOCK): {e}")
+        return False
 
 
 class MotorVelAccController:
     """高擎电机速度+加速度控制器"""
 
-    def __init__(self, channel: str = 'can0', bitrate: int = 1000000, motor_id: int = 1):
+    def __init__(self, channel: str = 'can0', bitrate: int = 1000000, motor_id: int = 1,
+                 rt_cpu: Optional[int] = None, rt_priority: int = 80, rate: float = 100.0):
         self.motor_id = motor_id
         self.channel = channel
+        # 实时调度: 指定 rt_cpu 时控制线程绑定该核并使用 SCHED_FIFO
+        self.rt_cpu = rt_cpu
+        self.rt_priority = rt_priority
         print(f"初始化 CAN: {channel}")
         try:
             self.bus = can.interface.Bus(channel=channel, interface='socketcan')
             # 清空缓冲区
-            while self.bus.recv(timeout=0.0):
-                pass
+            self._flush_rx()
         except OSError:
             print("❌ 错误: CAN 接口未打开")
             sys.exit(1)
 
         self.running = False
         self.control_thread = None
+        # 测试波形: 预编码帧迭代器由控制线程逐周期取用，播放完毕后置位 _traj_done
+        self._trajectory = None
+        self._traj_done = threading.Event()
+        self._saved_switch_interval = None
+        self._gc_was_enabled = None
 
         # 控制参数
         self.target_vel = 0.0
@@ -47,74 +96,176 @@ class MotorVelAccController:
         # 我们设置急刹时的加速度为 30.0，接近极限
         self.MAX_BRAKE_ACC = 30.0
 
+        # 控制周期 (默认 100Hz)
+        self.CONTROL_PERIOD = 1.0 / rate
+
+        # 预构建使能/禁用阶段的常量帧
+        # 需确认的配置帧 ID 置 Bit15=1 请求电机回复，用回复代替固定延时确认已生效；
+        # 直接连发的帧保持原 ID，不产生无人读取的回复
+        arb_id = 0x0000 | self.motor_id
+        ack_id = 0x8000 | self.motor_id
+        self._init_steps = tuple(
+            (note, build_msg(arb_id if settle is None else ack_id, payload), settle)
+            for note, payload, settle in _INIT_STEPS)
+        self._disable_msg = build_msg(arb_id, DISABLE)
+
+        # 0xAD 控制帧: 结构 [PosL, PosH, VelL, VelH, AccL, AccH, 0x50, 0x50]
+        # 由 set_velocity/set_acceleration 在设置侧预编码成完整帧，控制线程只发送
+        # self._active_frame；换帧是一次引用赋值 (CPython 下原子)，无需加锁
+        self._raw_tx, self._ctrl_write = self._init_ctrl_path()
+        self._vel_i16 = 0
+        # 行驶加速度只在 set_acceleration 中重算；急刹加速度为常量 (30.0 -> 30000)
+        self._drive_acc_i16 = clamp_i16(int(self.target_acc * self.FACTOR_ACC))
+        self._brake_acc_i16 = clamp_i16(int(self.MAX_BRAKE_ACC * self.FACTOR_ACC))
+        # 急刹帧 (Vel=0, Acc=MAX_BRAKE_ACC) 内容固定，只编码一次
+        self._brake_frame = self._encode_ctrl(0, self._brake_acc_i16)
+        self._active_frame = self._brake_frame
+
+    def _flush_rx(self):
+        """清空接收缓冲: SocketCAN 下直接从底层 socket 非阻塞读弃，不为每帧构造 can.Message"""
+        sock = getattr(self.bus, 'socket', None)
+        if sock is None:
+            while self.bus.recv(timeout=0.0):
+                pass
+            return
+
+        buf = bytearray(CANFD_MTU)
+        while True:
+            try:
+                sock.recv_into(buf, 0, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+
+    def _init_ctrl_path(self):
+        """
+        0xAD 控制帧发送路径，返回 (是否发送原始帧, 发送函数)
+        SocketCAN 下直接复用 python-can 的 CAN_RAW socket，发送预编码的 16 字节
+        can_frame，跳过每周期的 Message 校验与打包；
+        没有底层 socket 的后端 (如 virtual) 则发送预构建的 Message 走 bus.send
+        """
+        sock = getattr(self.bus, 'socket', None)
+        if sock is None:
+            return False, self.bus.send
+        return True, sock.send
+
+    def _encode_ctrl(self, vel_int: int, acc_int: int):
+        """按发送路径编码一帧 0xAD 指令: [Pos=0x8000 (速度模式), Vel, Acc]"""
+        if self._raw_tx:
+            buf = bytearray(_CTRL_RAW_FRAME)
+            INT16X3_STRUCT.pack_into(buf, 8, self.MAGIC_POS, vel_int, acc_int)
+            return bytes(buf)
+        buf = bytearray(_CTRL_PAYLOAD)
+        INT16X3_STRUCT.pack_into(buf, 0, self.MAGIC_POS, vel_int, acc_int)
+        return build_msg(0x00AD, buf)
+
     def send_frame(self, arbitration_id, data):
-        """发送CAN帧"""
-        msg = can.Message(arbitration_id=arbitration_id, data=data,
-                         is_extended_id=True, is_fd=False)
+        """发送CAN帧 (data 可为 list / bytes / bytearray)"""
+        self.send_msg(build_msg(arbitration_id, data))
+
+    def send_msg(self, msg: can.Message):
+        """发送预构建的CAN帧"""
         try:
             self.bus.send(msg)
         except can.CanError:
             print("❌ 发送错误")
 
+    def _wait_ack(self, timeout: float) -> bool:
+        """在 timeout 内等待源ID为本电机的回复帧 (bus.recv 内部以 select 等待)"""
+        deadline = time.monotonic() + timeout
+        while (remaining := deadline - time.monotonic()) > 0:
+            rx_msg = self.bus.recv(timeout=remaining)
+            if rx_msg is None:
+                break
+            if not rx_msg.is_error_frame and ((rx_msg.arbitration_id >> 8) & 0x7F) == self.motor_id:
+                return True
+        return False
+
+    def send_config(self, msg: can.Message, settle: float, ack_timeout: float = 0.01) -> bool:
+        """
+        发送配置帧并等待电机回复，收到即继续；
+        超时未收到 (固件不回复或接收不可用) 则补足原有的固定延时 settle
+        """
+        self._flush_rx()  # 丢弃旧回复，避免误判
+        self.send_msg(msg)
+        if self._wait_ack(ack_timeout):
+            return True
+        time.sleep(max(settle - ack_timeout, 0.0))
+        return False
+
     def enable_sequence(self):
         """初始化: 进模式 + 给力矩"""
         print(f"-> [ID {self.motor_id}] 初始化 (Vel+Acc Mode 0xAD)...")
-        arb_id = 0x0000 | self.motor_id
-
-        # 1. 写入模式: 0x0A (Position/Control Mode)
-        self.send_frame(arb_id, [0x01, 0x00, 0x0A, 0x50, 0x50, 0x50, 0x50, 0x50])
-        time.sleep(0.05)
 
-        # 2. 【必须】设置力矩限制 (Reg 0x22)
-        # 设为 3.0 Nm，确保有力气
-        print("   >>> 预设力矩限制: 3.0 Nm")
-        self.send_frame(arb_id, [0x0D, 0x22] + list(struct.pack('<f', 3.0)) + [0x50, 0x50])
-        time.sleep(0.02)
-
-        # 3. 预设 PID (速度环)
-        # Kp=2.0, Kd=0.2
-        self.send_frame(arb_id, [0x0D, 0x23] + list(struct.pack('<f', 2.0)) + [0x50, 0x50])
-        self.send_frame(arb_id, [0x0D, 0x24] + list(struct.pack('<f', 0.2)) + [0x50, 0x50])
+        for note, msg, settle in self._init_steps:
+            if note:
+                print(note)
+            if settle is None:
+                self.send_msg(msg)
+            else:
+                self.send_config(msg, settle)
 
         print("✅ 初始化完成")
 
     def control_loop(self):
-        """100Hz 发送 0xAD 指令流"""
+        """按 CONTROL_PERIOD (默认 100Hz) 发送 0xAD 指令流"""
+        period_ns = seconds_to_ns(self.CONTROL_PERIOD)
+        # 循环内不变的属性/方法提前绑定到局部变量 (LOAD_FAST)，
+        # 只有与用户线程共享的 running / _active_frame / _trajectory 每周期重新读取
+        write = self._ctrl_write
+        wait = wait_next_tick
+        traj_done = self._traj_done
+        ts = new_timespec()
+        tick = time.monotonic_ns()
         while self.running:
-            # 1. 准备位置数据 (Int16) -> 0x8000 代表速度模式
-            pos_int = self.MAGIC_POS
-
-            # 2. 准备速度数据
-            vel_int = int(self.target_vel * self.FACTOR_VEL)
-            vel_int = max(min(vel_int, 32767), -32768)
-
-            # 3. 准备加速度数据 (核心修改)
-            current_acc = self.target_acc
-
-            # --- 智能刹车逻辑 ---
-            # 如果目标速度是 0 (刹车)，且用户设定的加速度很小
-            # 强制使用最大加速度 (30.0)，实现"立刻停"
-            if self.target_vel == 0.0:
-                current_acc = self.MAX_BRAKE_ACC
-            # ------------------
-
-            acc_int = int(current_acc * self.FACTOR_ACC)
-            acc_int = max(min(acc_int, 32767), -32768)
-
-            # 4. 打包发送: [Pos, Vel, Acc] (3个 short)
-            # CAN ID: 0x00AD
-            data = struct.pack('<hhh', pos_int, vel_int, acc_int)
-            payload = list(data) + [0x50, 0x50]  # 补齐8字节
-
-            self.send_frame(0x00AD, payload)
+            # 发送预编码帧 (CAN ID: 0x00AD)；换算、限幅、急刹判断与打包均已在设置侧完成
+            # 播放测试波形时直接取轨迹的下一帧，不再另起一个定时循环写目标值
+            frame = self._active_frame
+            traj = self._trajectory
+            if traj is not None:
+                frame = next(traj, None)
+                if frame is None:
+                    # 播放完毕: 通知测试线程，恢复发送 _active_frame
+                    self._trajectory = None
+                    traj_done.set()
+                    frame = self._active_frame
+            try:
+                write(frame)
+            except (OSError, can.CanError):
+                print("❌ 发送错误")
+
+            tick = wait(tick, period_ns, ts)
+
+    def _setup_realtime(self):
+        """在控制线程内调用: 绑定CPU并切换到 SCHED_FIFO，权限不足时保持普通调度"""
+        try:
+            os.sched_setaffinity(0, {self.rt_cpu})
+        except (OSError, AttributeError) as e:
+            print(f"⚠️ 无法绑定 CPU {self.rt_cpu}: {e}")
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(self.rt_priority))
+        except (OSError, AttributeError) as e:
+            print(f"⚠️ 无法设置 SCHED_FIFO (需要 root 或 CAP_SYS_NICE): {e}")
 
-            time.sleep(0.01)  # 10ms 周期 (100Hz)
+    def _control_thread_main(self):
+        """控制线程入口"""
+        if self.rt_cpu is not None:
+            self._setup_realtime()
+        self.control_loop()
 
     def start_control(self):
         """启动控制线程"""
         if not self.running:
             self.running = True
-            self.control_thread = threading.Thread(target=self.control_loop)
+            # 缩短 GIL 切换间隔 (默认 5ms)：控制线程醒来后最多等 0.5ms 就能拿到 GIL，
+            # 主线程的输入/打印/计算不再把一帧推迟到下一个周期
+            self._saved_switch_interval = sys.getswitchinterval()
+            sys.setswitchinterval(0.0005)
+            # 运行期间关闭循环垃圾回收: 已有对象移入永久代 (freeze)，
+            # 避免分代回收在控制周期中途停顿；引用计数释放不受影响
+            self._gc_was_enabled = gc.isenabled()
+            gc.freeze()
+            gc.disable()
+            self.control_thread = threading.Thread(target=self._control_thread_main)
             self.control_thread.start()
 
     def stop_control(self):
@@ -122,10 +273,62 @@ class MotorVelAccController:
         self.running = False
         if self.control_thread:
             self.control_thread.join()
+        if self._saved_switch_interval is not None:
+            sys.setswitchinterval(self._saved_switch_interval)
+            self._saved_switch_interval = None
+        if self._gc_was_enabled is not None:
+            gc.unfreeze()
+            if self._gc_was_enabled:
+                gc.enable()
+            gc.collect()
+            self._gc_was_enabled = None
+
+    def _update_active_frame(self):
+        """
+        按当前目标切换控制线程发送的帧
+        智能刹车: 目标速度为 0 时换成急刹帧 (加速度 30.0)，实现"立刻停"
+        """
+        if self.target_vel == 0.0:
+            self._active_frame = self._brake_frame
+        else:
+            self._active_frame = self._encode_ctrl(self._vel_i16, self._drive_acc_i16)
+
+    def _apply_velocity(self, velocity: float):
+        """更新目标速度 (不打印)"""
+        self.target_vel = velocity
+        self._vel_i16 = clamp_i16(int(velocity * self.FACTOR_VEL))
+        self._update_active_frame()
+
+    def _velocity_trajectory(self, velocities) -> tuple:
+        """将速度序列 (ndarray) 一次性换算为 (速度列表, Int16 列表)"""
+        vel_ints = np.clip(velocities * self.FACTOR_VEL, -32768, 32767).astype(np.int16)
+        return velocities.tolist(), vel_ints.tolist()
+
+    def _play_trajectory(self, velocities: list, vel_ints: list):
+        """把速度序列预编码成帧交给控制线程逐周期发送，阻塞至播放完毕 (期间降频显示进度)"""
+        if not velocities:
+            return
+        brake, drive_acc = self._brake_frame, self._drive_acc_i16
+        frames = [brake if v == 0.0 else self._encode_ctrl(vi, drive_acc)
+                  for v, vi in zip(velocities, vel_ints)]
+
+        self._traj_done.clear()
+        start = time.monotonic()
+        self._trajectory = iter(frames)
+        try:
+            while not self._traj_done.wait(0.2):
+                if not self.running:
+                    break
+                i = min(int((time.monotonic() - start) / self.CONTROL_PERIOD),
+                        len(velocities) - 1)
+                sys.stdout.write(f"\r   -> 目标速度: {velocities[i]:+7.3f} r/s   ")
+            print()
+        finally:
+            self._trajectory = None
 
     def set_velocity(self, velocity: float):
         """设置目标速度"""
-        self.target_vel = velocity
+        self._apply_velocity(velocity)
         if velocity == 0.0:
             print(f"   -> 🛑 执行急刹 (Acc={self.MAX_BRAKE_ACC})")
         else:
@@ -134,12 +337,13 @@ class MotorVelAccController:
     def set_acceleration(self, acceleration: float):
         """设置加速度"""
         self.target_acc = abs(acceleration)
+        self._drive_acc_i16 = clamp_i16(int(self.target_acc * self.FACTOR_ACC))
+        self._update_active_frame()
         print(f"   -> 行驶加速度设为: {self.target_acc} r/s^2")
 
     def disable(self):
         """禁用电机"""
-        arb_id = 0x0000 | self.motor_id
-        self.send_frame(arb_id, [0x01, 0x00, 0x00, 0x50, 0x50, 0x50, 0x50, 0x50])
+        self.send_msg(self._disable_msg)
         print("🛑 失能")
 
     def run_sine_wave_test(self, amplitude: float, frequency: float, duration: float):
@@ -149,14 +353,14 @@ class MotorVelAccController:
         print(f"幅值: {amplitude} r/s, 频率: {frequency} Hz, 时长: {duration}s")
         print(f"{'='*50}")
 
-        start_time = time.time()
+        # 时长已知，一次性向量化生成每个周期的目标速度及其 Int16 值，由控制线程逐周期发送
+        period = self.CONTROL_PERIOD
+        t = np.arange(1, round(duration / period) + 1) * period
+        velocities, vel_ints = self._velocity_trajectory(
+            amplitude * np.sin(2 * np.pi * frequency * t))
+
         try:
-            while time.time() - start_time < duration:
-                elapsed = time.time() - start_time
-                # 正弦波速度
-                target_vel = amplitude * math.sin(2 * math.pi * frequency * elapsed)
-                self.set_velocity(target_vel)
-                time.sleep(0.01)
+            self._play_trajectory(velocities, vel_ints)
         except KeyboardInterrupt:
             print("\n⚠️ 测试中断")
         finally:
@@ -187,15 +391,14 @@ class MotorVelAccController:
         print(f"从 {start_vel} r/s 到 {end_vel} r/s, 时长: {duration}s")
         print(f"{'='*50}")
 
-        start_time = time.time()
+        # 线性插值轨迹一次性生成 (不含终点，与按时长截止的循环一致)
+        period = self.CONTROL_PERIOD
+        steps = max(round(duration / period), 1)
+        velocities, vel_ints = self._velocity_trajectory(
+            np.linspace(start_vel, end_vel, steps, endpoint=False))
+
         try:
-            while time.time() - start_time < duration:
-                elapsed = time.time() - start_time
-                progress = elapsed / duration
-                # 线性插值
-                target_vel = start_vel + (end_vel - start_vel) * progress
-                self.set_velocity(target_vel)
-                time.sleep(0.01)
+            self._play_trajectory(velocities, vel_ints)
         except KeyboardInterrupt:
             print("\n⚠️ 测试中断")
         finally:
@@ -213,43 +416,83 @@ class MotorVelAccController:
         print(f"  q             -> 退出")
         print(f"{'='*50}")
 
+        # 非阻塞读取 stdin: 每 0.1s 醒来一次，控制线程退出时及时结束，不会卡在 input() 上
+        # 直接 os.read 原始 fd 自行切行，避免 sys.stdin 的缓冲吞下一次到达的多行而 select 不再就绪
+        sel = selectors.DefaultSelector()
+        pending = b''
         try:
-            while True:
-                # 显示当前状态
-                status = f"\r(Vel={self.target_vel:.1f}, Acc={self.target_acc:.1f}) > "
-                sys.stdout.write(status)
-                sys.stdout.flush()
-
-                raw = input().strip().lower()
-
-                if raw in ['q', 'exit']:
-                    break
-                if not raw:
+            try:
+                fd = sys.stdin.fileno()
+                sel.register(fd, selectors.EVENT_READ)
+            except (OSError, ValueError):
+                # stdin 无法轮询 (如重定向自普通文件，epoll 拒绝注册)：退回逐行阻塞读取
+                fd = None
+
+            prompt = True
+            while self.running:
+                if prompt:
+                    # 显示当前状态
+                    status = f"\r(Vel={self.target_vel:.1f}, Acc={self.target_acc:.1f}) > "
+                    sys.stdout.write(status)
+                    sys.stdout.flush()
+                    prompt = False
+
+                if fd is None:
+                    line = sys.stdin.readline()
+                    if not line:  # EOF
+                        break
+                    prompt = True
+                    if not self._handle_command(line.strip().lower()):
+                        return
                     continue
 
-                parts = raw.split()
-
-                try:
-                    if parts[0] == 'acc':
-                        val = float(parts[1])
-                        self.set_acceleration(val)
-                    else:
-                        val = float(parts[0])
-                        self.set_velocity(val)
-                except ValueError:
-                    print("输入错误")
+                if not sel.select(0.1):
+                    continue
+                chunk = os.read(fd, 1024)
+                if not chunk:  # EOF: 末行可能没有换行符
+                    if pending:
+                        self._handle_command(pending.decode(errors='replace').strip().lower())
+                    break
+                pending += chunk
+                while b'\n' in pending:
+                    line, pending = pending.split(b'\n', 1)
+                    prompt = True
+                    if not self._handle_command(line.decode(errors='replace').strip().lower()):
+                        return
 
         except KeyboardInterrupt:
             print("\n中断")
         finally:
+            sel.close()
             self.set_velocity(0.0)
 
+    def _handle_command(self, raw: str) -> bool:
+        """处理一条交互指令，返回 False 表示退出"""
+        if raw in ['q', 'exit']:
+            return False
+        if not raw:
+            return True
+
+        parts = raw.split()
+
+        try:
+            if parts[0] == 'acc':
+                val = float(parts[1])
+                self.set_acceleration(val)
+            else:
+                val = float(parts[0])
+                self.set_velocity(val)
+        except ValueError:
+            print("输入错误")
+        return True
+
 
 def main():
     parser = argparse.ArgumentParser(description='高擎电机速度+加速度控制')
     parser.add_argument('--channel', type=str, default='can0', help='CAN通道')
     parser.add_argument('--bitrate', type=int, default=1000000, help='CAN波特率')
     parser.add_argument('--motor_id', type=int, default=1, help='电机ID')
+    parser.add_argument('--rate', type=float, default=100.0, help='控制频率 (Hz)')
     parser.add_argument('--mode', type=str, default='interactive',
                        choices=['interactive', 'sine', 'step', 'ramp'],
                        help='控制模式')
@@ -263,10 +506,20 @@ def main():
     parser.add_argument('--start_vel', type=float, help='斜坡起始速度')
     parser.add_argument('--end_vel', type=float, help='斜坡结束速度')
 
+    # 实时参数
+    parser.add_argument('--rt-cpu', type=int, help='控制线程绑定的CPU核 (启用 SCHED_FIFO + mlockall)')
+    parser.add_argument('--rt-priority', type=int, default=80, help='SCHED_FIFO 优先级 (1-99)')
+
     args = parser.parse_args()
+    if args.rate <= 0:
+        parser.error('--rate 必须大于 0')
+
+    if args.rt_cpu is not None:
+        lock_process_memory()
 
     # 创建控制器
-    controller = MotorVelAccController(args.channel, args.bitrate, args.motor_id)
+    controller = MotorVelAccController(args.channel, args.bitrate, args.motor_id,
+                                       args.rt_cpu, args.rt_priority, args.rate)
 
     try:
         # 使能电机